@@ -1,13 +1,17 @@
-import json
+import asyncio
+import io
 from typing import Dict, List
 
 from bisheng.api.v1.schemas import ChatMessage, ChatResponse
+from bisheng.cache.flow import InMemoryCache
 from bisheng.chat.manager import ChatManager
-from bisheng.chat.utils import extract_answer_keys, process_graph
-from bisheng.database.base import get_session
+from bisheng.chat.utils import extract_answer_keys, literal_eval_with_document, process_graph
+from bisheng.database.base import db_service, session_getter
+from bisheng.database.models.base import orjson_dumps
 from bisheng.database.models.model_deploy import ModelDeploy
 from bisheng.database.models.recall_chunk import RecallChunk
 from bisheng.database.models.report import Report
+from bisheng.settings import settings
 from bisheng.utils.docx_temp import test_replace_string
 from bisheng.utils.logger import logger
 from bisheng.utils.minio_client import MinioClient
@@ -16,6 +20,21 @@ from bisheng_langchain.chains.autogen.auto_gen import AutoGenChain
 from langchain.docstore.document import Document
 from sqlmodel import select
 
+# 模型上线状态很少变化，短时间内缓存，避免每次溯源都查库
+model_deploy_cache = InMemoryCache(max_size=16, expiration_time=60)
+
+
+def get_model_deploy(model: str):
+    """返回模型的 (status, endpoint)，模型未部署时返回 None"""
+    deploy = model_deploy_cache.get(model)
+    if deploy is None:
+        with session_getter(db_service) as db_session:
+            row = db_session.exec(
+                select(ModelDeploy.status, ModelDeploy.endpoint).where(ModelDeploy.model == model)).first()
+        deploy = tuple(row) if row else ()
+        model_deploy_cache.set(model, deploy)
+    return deploy or None
+
 
 class Handler:
 
@@ -46,7 +65,7 @@ class Handler:
         chat_inputs.pop('data') if 'data' in chat_inputs else {}
         chat_inputs.pop('id') if 'id' in chat_inputs else ''
         key = get_cache_key(client_id, chat_id)
-        artifacts = session.in_memory_cache.get(key + '_artifacts')
+        artifacts = session.get_artifacts(key)
         if artifacts:
             for k, value in artifacts.items():
                 if k in chat_inputs:
@@ -63,17 +82,19 @@ class Handler:
         result = await self.process_message(session, client_id, chat_id, chat_inputs, user_id)
         # judge end type
         start_resp = ChatResponse(type='start', user_id=user_id)
+        stopped = langchain_object.stop_status()
+        if stopped:
+            start_resp.category = 'divider'
         await session.send_json(client_id, chat_id, start_resp)
 
-        if langchain_object.stop_status():
-            start_resp.category = 'divider'
+        if stopped:
             response = ChatResponse(message='主动退出', type='end', category='divider', user_id=user_id)
             await session.send_json(client_id, chat_id, response)
 
         # build report
-        db_session = next(get_session())
-        template = db_session.exec(
-            select(Report).where(Report.flow_id == client_id).order_by(Report.id.desc())).first()
+        with session_getter(db_service) as db_session:
+            template = db_session.exec(
+                select(Report).where(Report.flow_id == client_id).order_by(Report.id.desc())).first()
         if not template:
             logger.error('template not support')
             return
@@ -89,9 +110,8 @@ class Handler:
                                     'file_name': report_name
                                 }],
                                 user_id=user_id)
-        await session.send_json(client_id, chat_id, response)
         close_resp = ChatResponse(type='close', category='system', user_id=user_id)
-        await session.send_json(client_id, chat_id, close_resp)
+        await session.send_json_batch(client_id, chat_id, response, close_resp)
 
     async def process_message(self,
                               session: ChatManager,
@@ -105,7 +125,7 @@ class Handler:
         is_begin = payload.get('is_begin', True)
         key = get_cache_key(client_id, chat_id)
 
-        artifacts = session.in_memory_cache.get(key + '_artifacts')
+        artifacts = session.get_artifacts(key)
         if artifacts:
             for k, value in artifacts.items():
                 if k in chat_inputs and value:
@@ -120,27 +140,27 @@ class Handler:
         if is_begin:
             # 从file auto trigger process_message， the question already saved
             session.chat_history.add_message(client_id, chat_id, chat_inputs)
-        start_resp = ChatResponse(type='start', user_id=user_id)
+        start_resp = ChatResponse.construct(type='start', user_id=user_id)
         await session.send_json(client_id, chat_id, start_resp)
 
         # is_first_message = len(self.chat_history.get_history(client_id=client_id)) <= 1
         # Generate result and thought
         try:
-            logger.debug(f'Generating result and thought key={key}')
+            logger.debug('Generating result and thought key={}', key)
             langchain_object = session.in_memory_cache.get(key)
             result, intermediate_steps, source_doucment = await process_graph(
                 langchain_object=langchain_object,
                 chat_inputs=chat_inputs,
-                websocket=session.active_connections[get_cache_key(client_id, chat_id)],
+                websocket=session.active_connections[key],
             )
         except Exception as e:
             # Log stack trace
             logger.exception(e)
-            end_resp = ChatResponse(type='end',
-                                    intermediate_steps=f'分析出错，{str(e)}',
-                                    user_id=user_id)
+            end_resp = ChatResponse.construct(type='end',
+                                              intermediate_steps=f'分析出错，{str(e)}',
+                                              user_id=user_id)
             await session.send_json(client_id, chat_id, end_resp)
-            close_resp = ChatResponse(type='close', user_id=user_id)
+            close_resp = ChatResponse.construct(type='close', user_id=user_id)
             if not chat_id:
                 # 技能编排页面， 无法展示intermediate
                 await session.send_json(client_id, chat_id, start_resp)
@@ -178,43 +198,53 @@ class Handler:
             else:
                 source = 1
 
-        if source:
-            for doc in source_doucment:
-                # 确保每个chunk 都可溯源
-                if 'bbox' not in doc.metadata or not doc.metadata['bbox']:
-                    source = False
-        # 最终结果
-        if isinstance(langchain_object, AutoGenChain):
-            # 群聊，最后一条消息重复，不进行返回
-            start_resp.category = 'divider'
-            await session.send_json(client_id, chat_id, start_resp)
-            response = ChatResponse(message='本轮结束', type='end', category='divider', user_id=user_id)
-            await session.send_json(client_id, chat_id, response)
-        else:
-            # 正常
+        if source and not all(doc.metadata.get('bbox') for doc in source_doucment):
+            # 确保每个chunk 都可溯源
+            source = False
+        keywords_task = None
+        if source and (is_begin or isinstance(langchain_object, AutoGenChain)):
+            # 有最终结果的分支才处理召回的chunk，关键词抽取与结果发送并行
+            keywords_task = asyncio.create_task(self.extract_answer_keywords(result))
+        try:
+            # 最终结果
+            if isinstance(langchain_object, AutoGenChain):
+                # 群聊，最后一条消息重复，不进行返回
+                start_resp.category = 'divider'
+                response = ChatResponse.construct(message='本轮结束',
+                                                  type='end',
+                                                  category='divider',
+                                                  user_id=user_id)
+                await session.send_json_batch(client_id, chat_id, start_resp, response)
+            else:
+                # 正常
+                if is_begin:
+                    start_resp.category = 'answer'
+                    response = ChatResponse(message=result,
+                                            extra=orjson_dumps(extra, indent_2=False),
+                                            type='end',
+                                            category='answer',
+                                            user_id=user_id,
+                                            source=int(source))
+                    await session.send_json_batch(client_id, chat_id, start_resp, response)
+
+            # 循环结束
             if is_begin:
-                start_resp.category = 'answer'
-                await session.send_json(client_id, chat_id, start_resp)
-                response = ChatResponse(message=result,
-                                        extra=json.dumps(extra),
-                                        type='end',
-                                        category='answer',
-                                        user_id=user_id,
-                                        source=int(source))
-                await session.send_json(client_id, chat_id, response)
-
-        # 循环结束
-        if is_begin:
-            close_resp = ChatResponse(type='close', user_id=user_id)
-            await session.send_json(client_id, chat_id, close_resp)
+                close_resp = ChatResponse.construct(type='close', user_id=user_id)
+                await session.send_json(client_id, chat_id, close_resp)
+        except BaseException:
+            # 发送失败时不再需要关键词，避免遗留未等待的任务
+            if keywords_task:
+                keywords_task.cancel()
+            raise
 
-        if source:
+        if keywords_task:
             # 处理召回的chunk
             await self.process_source_document(
                 source_doucment,
                 chat_id,
                 response.message_id,
                 result,
+                keywords_task,
             )
         return result
 
@@ -225,20 +255,22 @@ class Handler:
         batch_question = payload['inputs']['questions']
         # 如果L3
         file = ChatMessage(is_bot=False, message=file_name, type='end', user_id=user_id)
-        session.chat_history.add_message(client_id, chat_id, file)
-        start_resp = ChatResponse(type='start', category='system', user_id=user_id)
+        await asyncio.to_thread(session.chat_history.add_message, client_id, chat_id, file)
+        start_resp = ChatResponse.construct(type='start', category='system', user_id=user_id)
 
         key = get_cache_key(client_id, chat_id)
         langchain_object = session.in_memory_cache.get(key)
         input_key = langchain_object.input_keys[0]
 
-        report = ''
-        logger.info(f'process_file batch_question={batch_question}')
+        report_parts: List[str] = []
+        logger.info('process_file batch_question={}', batch_question)
+        # 问题只能顺序执行：共用同一个 langchain_object（memory、callbacks）和同一个 websocket，
+        # 流式输出的 token 不带问题标识，并发会导致前端无法区分各问题的回答
         for question in batch_question:
             if not question:
                 continue
             payload = {'inputs': {input_key: question}, 'is_begin': False}
-            start_resp.category == 'question'
+            start_resp.category = 'question'
             await session.send_json(client_id, chat_id, start_resp)
             step_resp = ChatResponse(type='end',
                                      intermediate_steps=question,
@@ -253,23 +285,22 @@ class Handler:
             await session.send_json(client_id, chat_id, response_step)
             response_step.type = 'end'
             await session.send_json(client_id, chat_id, response_step)
-            report = f"""{report}### {question} \n {result} \n """
+            report_parts.append(f'### {question} \n {result} \n ')
 
+        report = ''.join(report_parts)
         start_resp.category = 'report'
-        await session.send_json(client_id, chat_id, start_resp)
         response = ChatResponse(type='end',
                                 intermediate_steps=report,
                                 category='report',
                                 user_id=user_id)
-        await session.send_json(client_id, chat_id, response)
-        close_resp = ChatResponse(type='close', category='system', user_id=user_id)
-        await session.send_json(client_id, chat_id, close_resp)
+        close_resp = ChatResponse.construct(type='close', category='system', user_id=user_id)
+        await session.send_json_batch(client_id, chat_id, start_resp, response, close_resp)
 
     async def process_autogen(self, session: ChatManager, client_id: str, chat_id: str,
                               payload: dict, user_id: int):
         key = get_cache_key(client_id, chat_id)
         langchain_object = session.in_memory_cache.get(key)
-        logger.info(f'reciever_human_interactive langchain={langchain_object}')
+        logger.info('reciever_human_interactive langchain={}', langchain_object)
         action = payload.get('action')
         if action.lower() == 'stop':
             if hasattr(langchain_object, 'stop'):
@@ -289,7 +320,7 @@ class Handler:
 
     async def intermediate_logs(self, session: ChatManager, client_id, chat_id, user_id,
                                 intermediate_steps):
-        end_resp = ChatResponse(type='end', user_id=user_id)
+        end_resp = ChatResponse.construct(type='end', user_id=user_id)
         if not intermediate_steps:
             return await session.send_json(client_id, chat_id, end_resp, add=False)
 
@@ -316,10 +347,18 @@ class Handler:
         else:
             # agent model will produce the steps log
             if chat_id and intermediate_steps.strip():
-                for s in intermediate_steps.split('\n'):
+                for s in io.StringIO(intermediate_steps):
+                    s = s.rstrip('\n')
+                    if not s:
+                        # 空行不会入库，跳过
+                        continue
                     if 'source_documents' in s:
-                        answer = eval(s.split(':', 1)[1])
-                        if 'result' in answer:
+                        try:
+                            answer = literal_eval_with_document(s.split(':', 1)[1])
+                        except (ValueError, SyntaxError, TypeError, IndexError, RecursionError):
+                            # 无法解析的日志原样保留
+                            answer = None
+                        if isinstance(answer, dict) and 'result' in answer:
                             s = 'Answer: ' + answer.get('result')
                     msg = ChatResponse(intermediate_steps=s, type='end', user_id=user_id)
                     steps.append(msg)
@@ -328,43 +367,60 @@ class Handler:
                 end_resp.intermediate_steps = intermediate_steps
         await session.send_json(client_id, chat_id, end_resp, add=False)
 
-        for step in steps:
-            # save chate message
-            session.chat_history.add_message(client_id, chat_id, step)
-
-    async def process_source_document(self, source_document: List[Document], chat_id, message_id,
-                                      answer):
-        if not source_document:
-            return
+        # save chate message, 一次提交，放到线程中避免阻塞事件循环
+        if steps:
+            await asyncio.to_thread(session.chat_history.add_messages, client_id, chat_id, steps)
 
-        from bisheng.settings import settings
+    def get_answer_keywords(self, answer):
         # 使用大模型进行关键词抽取，模型配置临时方案
         keyword_conf = settings.get_default_llm() or {}
         host_base_url = keyword_conf.get('host_base_url')
         model = keyword_conf.get('model')
 
         if model and not host_base_url:
-            db_session = next(get_session())
-            model_deploy = db_session.exec(
-                select(ModelDeploy).where(ModelDeploy.model == model)).first()
+            model_deploy = get_model_deploy(model)
             if model_deploy:
-                model = model if model_deploy.status == '已上线' else None
-                host_base_url = model_deploy.endpoint
+                status, host_base_url = model_deploy
+                model = model if status == '已上线' else None
             else:
                 logger.error('不能使用配置模型进行关键词抽取，配置不正确')
 
-        answer_keywords = extract_answer_keys(answer, model, host_base_url)
-        for doc in source_document:
-            if 'bbox' in doc.metadata:
-                # 表示支持溯源
-                db_session = next(get_session())
-                content = doc.page_content
-                recall_chunk = RecallChunk(chat_id=chat_id,
-                                           keywords=json.dumps(answer_keywords),
-                                           chunk=content,
-                                           file_id=doc.metadata.get('file_id'),
-                                           meta_data=json.dumps(doc.metadata),
-                                           message_id=message_id)
-                db_session.add(recall_chunk)
+        return extract_answer_keys(answer, model, host_base_url)
+
+    async def extract_answer_keywords(self, answer):
+        # 模型配置查询和 llm 调用都是阻塞的，一起放到线程中执行，避免阻塞事件循环
+        return await asyncio.to_thread(self.get_answer_keywords, answer)
+
+    async def process_source_document(self,
+                                      source_document: List[Document],
+                                      chat_id,
+                                      message_id,
+                                      answer,
+                                      keywords_task: asyncio.Task = None):
+        if not source_document:
+            return
+
+        if keywords_task is None:
+            answer_keywords = await self.extract_answer_keywords(answer)
+        else:
+            answer_keywords = await keywords_task
+        keywords = orjson_dumps(answer_keywords, indent_2=False)
+        # 只保存支持溯源的chunk，一次提交
+        recall_chunks = [
+            RecallChunk(chat_id=chat_id,
+                        keywords=keywords,
+                        chunk=doc.page_content,
+                        file_id=doc.metadata.get('file_id'),
+                        meta_data=orjson_dumps(doc.metadata, indent_2=False),
+                        message_id=message_id) for doc in source_document
+            if doc.metadata.get('bbox')
+        ]
+        if not recall_chunks:
+            return
+        try:
+            with session_getter(db_service) as db_session:
+                db_session.add_all(recall_chunks)
                 db_session.commit()
-                db_session.refresh(recall_chunk)
+        except Exception as e:
+            # session_getter 已回滚
+            logger.exception(e)
@@ -11,9 +11,10 @@ from bisheng.api.v1.schemas import ChatMessage, ChatResponse, FileResponse
 from bisheng.cache import cache_manager
 from bisheng.cache.flow import InMemoryCache
 from bisheng.cache.manager import Subject
-from bisheng.database.base import get_session
+from bisheng.database.base import db_service, session_getter
+from bisheng.database.models.base import orjson_dumps
 from bisheng.database.models.user import User
-from bisheng.processing.process import process_tweaks
+from bisheng.processing.process import apply_tweaks, validate_input
 from bisheng.utils.logger import logger
 from bisheng.utils.threadpool import ThreadPoolManager
 from bisheng.utils.util import get_cache_key
@@ -30,26 +31,40 @@ class ChatHistory(Subject):
     def add_message(self, client_id: str, chat_id: str, message: ChatMessage):
         """Add a message to the chat history."""
 
-        if chat_id and (message.message or message.intermediate_steps
-                        or message.files) and message.type != 'stream':
-            with next(get_session()) as seesion:
+        self.add_messages(client_id, chat_id, [message])
+
+    def add_messages(self, client_id: str, chat_id: str, messages: List[ChatMessage]):
+        """Add several messages to the chat history with a single commit."""
+
+        to_save = [
+            message for message in messages if chat_id and (
+                message.message or message.intermediate_steps or message.files) and message.type != 'stream'
+        ]
+        if to_save:
+            with session_getter(db_service) as seesion:
                 from bisheng.database.models.message import ChatMessage
-                msg = message.copy()
-                msg.message = str(msg.message) if isinstance(msg.message, dict) else msg.message
-                files = json.dumps(msg.files) if msg.files else ''
-                msg.__dict__.pop('files')
-                db_message = ChatMessage(flow_id=client_id,
-                                         chat_id=chat_id,
-                                         files=files,
-                                         **msg.__dict__)
-                logger.info(f'chat={db_message}')
-                seesion.add(db_message)
+                db_messages = []
+                for message in to_save:
+                    msg = message.copy()
+                    msg.message = str(msg.message) if isinstance(msg.message, dict) else msg.message
+                    files = json.dumps(msg.files) if msg.files else ''
+                    msg.__dict__.pop('files')
+                    db_message = ChatMessage(flow_id=client_id,
+                                             chat_id=chat_id,
+                                             files=files,
+                                             **msg.__dict__)
+                    logger.info(f'chat={db_message}')
+                    db_messages.append(db_message)
+                seesion.add_all(db_messages)
+                # flush 后即可拿到自增id，无需逐条 refresh
+                seesion.flush()
+                for message, db_message in zip(to_save, db_messages):
+                    message.message_id = db_message.id
                 seesion.commit()
-                seesion.refresh(db_message)
-                message.message_id = db_message.id
 
-        if not isinstance(message, FileResponse):
-            self.notify()
+        for message in messages:
+            if not isinstance(message, FileResponse):
+                self.notify()
 
     def empty_history(self, client_id: str, chat_id: str):
         """Empty the chat history for a client."""
@@ -113,11 +128,16 @@ class ChatManager:
         await websocket.send_text(message)
 
     async def send_json(self, client_id: str, chat_id: str, message: ChatMessage, add=True):
+        await self.send_json_batch(client_id, chat_id, message, add=add)
+
+    async def send_json_batch(self, client_id: str, chat_id: str, *messages: ChatMessage, add=True):
+        """同一连接上连续发送多条消息，保证顺序，只查找一次连接"""
         websocket = self.active_connections[get_cache_key(client_id, chat_id)]
-        # 增加消息记录
-        if add:
-            self.chat_history.add_message(client_id, chat_id, message)
-        await websocket.send_json(message.dict())
+        for message in messages:
+            # 增加消息记录
+            if add:
+                self.chat_history.add_message(client_id, chat_id, message)
+            await websocket.send_text(orjson_dumps(message.dict(), indent_2=False))
 
     async def close_connection(self, client_id: str, chat_id: str, code: int, reason: str):
         if websocket := self.active_connections[get_cache_key(client_id, chat_id)]:
@@ -146,6 +166,20 @@ class ChatManager:
         self.in_memory_cache.set(client_id, langchain_object)
         return client_id in self.in_memory_cache
 
+    def set_artifacts(self, key: str, artifacts: dict):
+        """
+        Set the artifacts built together with the langchain object cached under key.
+        """
+
+        self.in_memory_cache.set(f'{key}_artifacts', artifacts)
+
+    def get_artifacts(self, key: str) -> dict:
+        """
+        Get the artifacts built together with the langchain object cached under key.
+        """
+
+        return self.in_memory_cache.get(f'{key}_artifacts')
+
     async def handle_websocket(
         self,
         client_id: str,
@@ -260,7 +294,7 @@ class ChatManager:
         if 'inputs' in payload and ('data' in payload['inputs']
                                     or 'file_path' in payload['inputs']):
             node_data = payload['inputs'].get('data', '') or [payload['inputs']]
-            graph_data = self.refresh_graph_data(graph_data, node_data)
+            graph_data = self.refresh_graph_data(graph_data, node_data, langchain_obj_key)
             self.set_cache(langchain_obj_key, None)  # rebuild object
             has_file = any(['InputFile' in nd.get('id') for nd in node_data])
         if has_file:
@@ -310,8 +344,8 @@ class ChatManager:
     def init_langchain_object(self, flow_id, chat_id, user_id, graph_data):
         key_node = get_cache_key(flow_id, chat_id)
         logger.info(f'init_langchain key={key_node}')
-        session = next(get_session())
-        db_user = session.get(User, user_id)  # 用来支持节点判断用户权限
+        with session_getter(db_service) as session:
+            db_user = session.get(User, user_id)  # 用来支持节点判断用户权限
         artifacts = {}
         graph = build_flow_no_yield(graph_data=graph_data,
                                     artifacts=artifacts,
@@ -331,10 +365,13 @@ class ChatManager:
             if node.base_type == 'inputOutput' and node.vertex_type != 'Report':
                 continue
             self.set_cache(key_node, node._built_object)
-            self.set_cache(key_node + '_artifacts', artifacts)
+            self.set_artifacts(key_node, artifacts)
         return graph
 
-    def refresh_graph_data(self, graph_data: dict, node_data: List[dict]):
+    def refresh_graph_data(self,
+                           graph_data: dict,
+                           node_data: List[dict],
+                           langchain_obj_key: str):
         tweak = {}
         for nd in node_data:
             if nd.get('id') not in tweak:
@@ -361,4 +398,23 @@ class ChatManager:
                 variables_value_list = tweak[nd.get('id')].get('variable_value', [])
                 variables_value_list.append(variable_value)
         """upload file to make flow work"""
-        return process_tweaks(graph_data, tweaks=tweak)
+        nodes_index = self.get_nodes_index(langchain_obj_key, graph_data)
+        for node_id, node_tweaks in tweak.items():
+            if node_tweaks and (node := nodes_index.get(node_id)):
+                apply_tweaks(node, node_tweaks)
+        return graph_data
+
+    def get_nodes_index(self, langchain_obj_key: str, graph_data: dict) -> Dict[str, dict]:
+        """同一会话内多次上传文件，复用 node_id -> node 的索引，避免每次遍历全部节点"""
+        index_key = f'{langchain_obj_key}_nodes_index'
+        cached = self.in_memory_cache.get(index_key)
+        if cached and cached[0] is graph_data:
+            return cached[1]
+        nodes_index = {}
+        for node in validate_input(graph_data, {}):
+            if isinstance(node, dict) and isinstance(node.get('id'), str):
+                nodes_index[node['id']] = node
+            else:
+                logger.warning("Each node should be a dictionary with an 'id' key of type str")
+        self.set_cache(index_key, (graph_data, nodes_index))
+        return nodes_index
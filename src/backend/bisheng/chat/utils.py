@@ -1,3 +1,5 @@
+import ast
+
 from bisheng.api.v1.schemas import ChatMessage
 from bisheng.interface.utils import try_setting_streaming_options
 from bisheng.processing.base import get_result_and_steps
@@ -5,6 +7,7 @@ from bisheng.utils.logger import logger
 from bisheng_langchain.chat_models import HostQwenChat
 from fastapi import WebSocket
 from langchain import LLMChain, PromptTemplate
+from langchain.docstore.document import Document
 
 
 async def process_graph(
@@ -69,3 +72,27 @@ def extract_answer_keys(answer, extract_model, host_base_url):
         keywords = jieba.analyse.extract_tags(answer, topK=100, withWeight=False)
 
     return keywords
+
+
+def _eval_node(node: ast.AST):
+    if isinstance(node, ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id == 'Document') or node.args or any(
+                kw.arg is None for kw in node.keywords):
+            raise ValueError(f'malformed node: {ast.dump(node)}')
+        return Document(**{kw.arg: _eval_node(kw.value) for kw in node.keywords})
+    if isinstance(node, ast.Dict):
+        if any(k is None for k in node.keys):
+            raise ValueError(f'malformed node: {ast.dump(node)}')
+        return {_eval_node(k): _eval_node(v) for k, v in zip(node.keys, node.values)}
+    if isinstance(node, ast.List):
+        return [_eval_node(elt) for elt in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_eval_node(elt) for elt in node.elts)
+    return ast.literal_eval(node)
+
+
+def literal_eval_with_document(expr: str):
+    """
+    安全解析 chain 输出的 repr，除字面量外只允许 Document(page_content=..., metadata=...)
+    """
+    return _eval_node(ast.parse(expr.strip(), mode='eval').body)
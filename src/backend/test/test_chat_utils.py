@@ -0,0 +1,29 @@
+import pytest
+from bisheng.chat.utils import literal_eval_with_document
+from langchain.docstore.document import Document
+
+
+def test_literal_eval_with_document():
+    answer = {
+        'query': '合同甲方是谁',
+        'result': '甲方是达梦公司',
+        'source_documents': [Document(page_content='甲方：达梦公司', metadata={'bbox': '[]', 'file_id': 1})]
+    }
+    # format_actions 输出的 Answer 行
+    line = f'Answer: {answer}'
+
+    parsed = literal_eval_with_document(line.split(':', 1)[1])
+    assert parsed['result'] == '甲方是达梦公司'
+    assert parsed['source_documents'][0].page_content == '甲方：达梦公司'
+    assert parsed['source_documents'][0].metadata == {'bbox': '[]', 'file_id': 1}
+
+
+@pytest.mark.parametrize('expr', [
+    "__import__('os').getcwd()",
+    "Document(page_content=__import__('os').getcwd())",
+    "Document('positional')",
+    '{**kwargs}',
+])
+def test_literal_eval_with_document_rejects_code(expr):
+    with pytest.raises(ValueError):
+        literal_eval_with_document(expr)